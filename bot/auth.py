@@ -4,23 +4,37 @@ from bot.config import WHITELIST_FILE, BOT_SECRET_WORD
 
 logger = logging.getLogger(__name__)
 
+# Parsed whitelist, reused until the file's mtime changes
+_wl_cache: dict[str, str] = {}
+_wl_mtime: int | None = None
+
 
 def _load_whitelist() -> dict[str, str]:
-    if WHITELIST_FILE.exists():
+    global _wl_cache, _wl_mtime
+    try:
+        mtime = WHITELIST_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        _wl_cache, _wl_mtime = {}, None
+        return _wl_cache
+    if mtime != _wl_mtime:
         with open(WHITELIST_FILE, "r") as f:
-            return json.load(f)
-    return {}
+            _wl_cache = json.load(f)
+        _wl_mtime = mtime
+    return _wl_cache
 
 
 def _save_whitelist(wl: dict[str, str]) -> None:
+    global _wl_cache, _wl_mtime
     with open(WHITELIST_FILE, "w") as f:
         json.dump(wl, f, indent=2)
+    _wl_cache = wl
+    _wl_mtime = WHITELIST_FILE.stat().st_mtime_ns
 
 
 def authenticate(user_id: int, username: str, secret: str) -> bool:
     if secret != BOT_SECRET_WORD:
         return False
-    wl = _load_whitelist()
+    wl = dict(_load_whitelist())
     wl[str(user_id)] = username or "unknown"
     _save_whitelist(wl)
     logger.info("User %s (%s) authorized", user_id, username)
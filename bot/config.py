@@ -16,7 +16,12 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "50"))
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "3000"))
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "6000"))
+OPENAI_USE_BATCH = os.getenv("OPENAI_USE_BATCH", "").lower() in ("1", "true", "yes")
+TRANSLATOR_MAX_RETRIES = int(os.getenv("TRANSLATOR_MAX_RETRIES", "5"))
 
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "apustota")
 STARS_PER_50_PAGES = int(os.getenv("STARS_PER_50_PAGES", "20"))
+
+# Unconfirmed jobs (and their files) are dropped after JOB_TTL_SECONDS
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
@@ -1,7 +1,10 @@
 """Generate cover images for translated books."""
 
+import functools
+import io
 import logging
 from pathlib import Path
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 logger = logging.getLogger(__name__)
@@ -26,65 +29,154 @@ _FONT_PATHS_REGULAR = [
 ]
 
 
-def _find_font(paths: list[str], size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
-    for p in paths:
-        if Path(p).exists():
-            return ImageFont.truetype(p, size)
+def _first_existing(paths: list[str]) -> str | None:
+    return next((p for p in paths if Path(p).exists()), None)
+
+
+# Resolved once at import; fonts don't appear or vanish while the bot runs
+_FONT_PATH = _first_existing(_FONT_PATHS)
+_FONT_PATH_REGULAR = _first_existing(_FONT_PATHS_REGULAR)
+
+
+@functools.lru_cache(maxsize=None)
+def _find_font(path: str | None, size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+    if path:
+        return ImageFont.truetype(path, size)
     return ImageFont.load_default()
 
 
-def _draw_gradient(draw: ImageDraw.ImageDraw, width: int, height: int) -> None:
-    """Draw a dark blue to near-black vertical gradient."""
-    for y in range(height):
-        ratio = y / height
-        r = int(15 * (1 - ratio))
-        g = int(25 * (1 - ratio) + 10 * ratio)
-        b = int(80 * (1 - ratio) + 20 * ratio)
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
+def _gradient_image(width: int, height: int) -> Image.Image:
+    """Build a dark blue to near-black vertical gradient in a single array op."""
+    ratio = (np.arange(height) / height)[:, None]
+    column = np.stack(
+        [
+            15 * (1 - ratio),
+            25 * (1 - ratio) + 10 * ratio,
+            80 * (1 - ratio) + 20 * ratio,
+        ],
+        axis=-1,
+    ).astype(np.uint8)
+    pixels = np.ascontiguousarray(np.broadcast_to(column, (height, width, 3)))
+    return Image.fromarray(pixels, "RGB")
+
+
+@functools.lru_cache(maxsize=1024)
+def _text_bbox(font, text: str) -> tuple[int, int, int, int]:
+    """Memoized font.getbbox — the same strings are measured on every cover."""
+    return font.getbbox(text)
+
+
+def _text_width(font, text: str) -> int:
+    bbox = _text_bbox(font, text)
+    return bbox[2] - bbox[0]
 
 
 def _wrap_text(text: str, font, max_width: int) -> list[str]:
-    """Word-wrap text to fit within max_width pixels."""
+    """Word-wrap text to fit within max_width pixels.
+
+    Line widths are estimated by summing per-word advances; the exact bbox
+    is only measured when the estimate lands within a character of the limit.
+    """
     words = text.split()
+    space_w = font.getlength(" ")
+    slack = _text_width(font, "a")
+    word_widths: dict[str, float] = {}
     lines: list[str] = []
-    current = ""
+    current: list[str] = []
+    current_w = 0.0
 
     for word in words:
-        test = f"{current} {word}".strip()
-        bbox = font.getbbox(test)
-        w = bbox[2] - bbox[0]
-        if w <= max_width:
-            current = test
+        word_w = word_widths.get(word)
+        if word_w is None:
+            word_w = word_widths[word] = font.getlength(word)
+        estimate = current_w + space_w + word_w if current else word_w
+
+        if not current or estimate <= max_width - slack:
+            fits = True
+        elif estimate > max_width + slack:
+            fits = False
         else:
-            if current:
-                lines.append(current)
-            current = word
+            fits = _text_width(font, " ".join([*current, word])) <= max_width
+
+        if fits:
+            current.append(word)
+            current_w = estimate
+        else:
+            lines.append(" ".join(current))
+            current = [word]
+            current_w = word_w
     if current:
-        lines.append(current)
+        lines.append(" ".join(current))
 
     return lines or [text]
 
 
+@functools.lru_cache(maxsize=1)
+def _cover_template() -> Image.Image:
+    """Render the static part of the cover: background gradient and bottom branding."""
+    img = _gradient_image(COVER_WIDTH, COVER_HEIGHT)
+    draw = ImageDraw.Draw(img)
+    brand_font = _find_font(_FONT_PATH_REGULAR, 36)
+    small_font = _find_font(_FONT_PATH_REGULAR, 30)
+
+    # --- Branding at bottom ---
+    brand_y = COVER_HEIGHT - 300
+    # Translated by line
+    trans_text = "Переведено с помощью"
+    bbox = _text_bbox(brand_font, trans_text)
+    w = bbox[2] - bbox[0]
+    draw.text(
+        ((COVER_WIDTH - w) // 2, brand_y),
+        trans_text,
+        fill=(140, 140, 170),
+        font=brand_font,
+    )
+    # Bot handle
+    handle_y = brand_y + 55
+    bbox = _text_bbox(brand_font, BOT_HANDLE)
+    w = bbox[2] - bbox[0]
+    draw.text(
+        ((COVER_WIDTH - w) // 2, handle_y),
+        BOT_HANDLE,
+        fill=(100, 160, 255),
+        font=brand_font,
+    )
+    # URL
+    url_y = handle_y + 50
+    bbox = _text_bbox(small_font, BOT_LINK)
+    w = bbox[2] - bbox[0]
+    draw.text(
+        ((COVER_WIDTH - w) // 2, url_y),
+        BOT_LINK,
+        fill=(100, 120, 160),
+        font=small_font,
+    )
+
+    return img
+
+
 def generate_cover(
     title: str,
     author: str,
     output_path: str | Path,
 ) -> Path:
-    """Generate a styled cover image for EPUB with translated title and branding."""
+    """Generate a styled cover image for EPUB and save it to output_path."""
     output_path = Path(output_path)
     output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_bytes(generate_cover_bytes(title, author))
+    logger.info("Cover generated: %s", output_path)
+    return output_path
 
-    img = Image.new("RGB", (COVER_WIDTH, COVER_HEIGHT))
-    draw = ImageDraw.Draw(img)
 
-    # Background gradient
-    _draw_gradient(draw, COVER_WIDTH, COVER_HEIGHT)
+def generate_cover_bytes(title: str, author: str) -> bytes:
+    """Generate a styled cover with translated title and branding, as PNG bytes."""
+    # Gradient + branding are the same on every cover
+    img = _cover_template().copy()
+    draw = ImageDraw.Draw(img)
 
     # Fonts
-    title_font = _find_font(_FONT_PATHS, 90)
-    author_font = _find_font(_FONT_PATHS_REGULAR, 48)
-    brand_font = _find_font(_FONT_PATHS_REGULAR, 36)
-    small_font = _find_font(_FONT_PATHS_REGULAR, 30)
+    title_font = _find_font(_FONT_PATH, 90)
+    author_font = _find_font(_FONT_PATH_REGULAR, 48)
 
     margin = 120
     usable_width = COVER_WIDTH - margin * 2
@@ -93,7 +185,7 @@ def generate_cover(
     title_lines = _wrap_text(title.upper(), title_font, usable_width)
     y = 600
     for line in title_lines[:6]:  # max 6 lines
-        bbox = title_font.getbbox(line)
+        bbox = _text_bbox(title_font, line)
         w = bbox[2] - bbox[0]
         x = (COVER_WIDTH - w) // 2
         draw.text((x, y), line, fill=(255, 255, 255), font=title_font)
@@ -111,44 +203,13 @@ def generate_cover(
     # --- Author ---
     if author:
         author_y = line_y + 60
-        bbox = author_font.getbbox(author)
+        bbox = _text_bbox(author_font, author)
         w = bbox[2] - bbox[0]
         x = (COVER_WIDTH - w) // 2
         draw.text((x, author_y), author, fill=(200, 200, 220), font=author_font)
 
-    # --- Branding at bottom ---
-    brand_y = COVER_HEIGHT - 300
-    # Translated by line
-    trans_text = "Переведено с помощью"
-    bbox = brand_font.getbbox(trans_text)
-    w = bbox[2] - bbox[0]
-    draw.text(
-        ((COVER_WIDTH - w) // 2, brand_y),
-        trans_text,
-        fill=(140, 140, 170),
-        font=brand_font,
-    )
-    # Bot handle
-    handle_y = brand_y + 55
-    bbox = brand_font.getbbox(BOT_HANDLE)
-    w = bbox[2] - bbox[0]
-    draw.text(
-        ((COVER_WIDTH - w) // 2, handle_y),
-        BOT_HANDLE,
-        fill=(100, 160, 255),
-        font=brand_font,
-    )
-    # URL
-    url_y = handle_y + 50
-    bbox = small_font.getbbox(BOT_LINK)
-    w = bbox[2] - bbox[0]
-    draw.text(
-        ((COVER_WIDTH - w) // 2, url_y),
-        BOT_LINK,
-        fill=(100, 120, 160),
-        font=small_font,
-    )
-
-    img.save(str(output_path), "PNG", quality=95)
-    logger.info("Cover generated: %s", output_path)
-    return output_path
+    # Gradient + a few text colours fit a 256-entry palette: ~3x less data to deflate and embed
+    paletted = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    buf = io.BytesIO()
+    paletted.save(buf, "PNG")
+    return buf.getvalue()
@@ -1,18 +1,42 @@
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+from collections.abc import AsyncIterator
 import aiosqlite
 from datetime import datetime
 from bot.config import DB_PATH
 
 logger = logging.getLogger(__name__)
 
+READ_POOL_SIZE = 4
+_CACHE_LOOKUP_BATCH = 500  # keys per IN (...) query, below SQLite's bound-parameter limit
+
+# Per-connection tuning, applied to the writer and every reader
+_CONN_PRAGMAS = """
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -64000;
+    PRAGMA mmap_size = 268435456;
+"""
+
+# One read-write connection plus a pool of read-only ones (WAL lets them run concurrently)
 _db: aiosqlite.Connection | None = None
+_readers: list[aiosqlite.Connection] = []
+_read_pool: asyncio.Queue[aiosqlite.Connection] | None = None
+
+
+async def _connect(pragmas: str) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(str(DB_PATH))
+    conn.row_factory = aiosqlite.Row
+    await conn.executescript(pragmas)
+    return conn
 
 
 async def init_db() -> None:
-    """Initialize database and create tables."""
-    global _db
-    _db = await aiosqlite.connect(str(DB_PATH))
-    _db.row_factory = aiosqlite.Row
+    """Initialize database, create tables and open the read pool."""
+    global _db, _read_pool
+    _db = await _connect(
+        "PRAGMA journal_mode = WAL;\nPRAGMA synchronous = NORMAL;\n" + _CONN_PRAGMAS
+    )
     await _db.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             tg_id INTEGER PRIMARY KEY,
@@ -30,13 +54,29 @@ async def init_db() -> None:
             created_at TEXT DEFAULT (datetime('now')),
             FOREIGN KEY (tg_id) REFERENCES users(tg_id)
         );
+        CREATE INDEX IF NOT EXISTS idx_tx_tgid_type ON transactions(tg_id, type);
+        CREATE TABLE IF NOT EXISTS translation_cache (
+            key TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_at TEXT DEFAULT (datetime('now'))
+        );
     """)
     await _db.commit()
-    logger.info("Database initialized: %s", DB_PATH)
+
+    _read_pool = asyncio.Queue()
+    for _ in range(READ_POOL_SIZE):
+        reader = await _connect(_CONN_PRAGMAS + "PRAGMA query_only = 1;")
+        _readers.append(reader)
+        _read_pool.put_nowait(reader)
+    logger.info("Database initialized: %s (%d readers)", DB_PATH, READ_POOL_SIZE)
 
 
 async def close_db() -> None:
-    global _db
+    global _db, _read_pool
+    for reader in _readers:
+        await reader.close()
+    _readers.clear()
+    _read_pool = None
     if _db:
         await _db.close()
         _db = None
@@ -48,67 +88,99 @@ def _conn() -> aiosqlite.Connection:
     return _db
 
 
-async def get_or_create_user(tg_id: int, username: str = "") -> dict:
-    """Get existing user or create new one. Returns user dict."""
+@asynccontextmanager
+async def _read_conn() -> AsyncIterator[aiosqlite.Connection]:
+    """Borrow a read-only connection from the pool."""
+    if _read_pool is None:
+        raise RuntimeError("Database not initialized")
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+async def _fetchone(sql: str, params: tuple = ()) -> aiosqlite.Row | None:
+    # The cursor is closed explicitly so the reader doesn't keep a stale WAL snapshot
+    async with _read_conn() as db, db.execute(sql, params) as cursor:
+        return await cursor.fetchone()
+
+
+async def _fetchall(sql: str, params: tuple = ()) -> list[aiosqlite.Row]:
+    async with _read_conn() as db, db.execute(sql, params) as cursor:
+        return list(await cursor.fetchall())
+
+
+async def get_or_create_user(tg_id: int, username: str = "") -> aiosqlite.Row:
+    """Get existing user or create new one. Returns the user row."""
     db = _conn()
     cursor = await db.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
     row = await cursor.fetchone()
-    if row:
-        if username and row["username"] != username:
-            await db.execute("UPDATE users SET username = ? WHERE tg_id = ?", (username, tg_id))
-            await db.commit()
-        return dict(row)
-    await db.execute(
-        "INSERT INTO users (tg_id, username) VALUES (?, ?)",
+    if row and (not username or row["username"] == username):
+        return row
+    # New user or changed username: one upsert that also returns the row
+    cursor = await db.execute(
+        "INSERT INTO users (tg_id, username) VALUES (?, ?) "
+        "ON CONFLICT(tg_id) DO UPDATE SET username = excluded.username "
+        "RETURNING *",
         (tg_id, username),
     )
-    await db.commit()
-    cursor = await db.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
     row = await cursor.fetchone()
-    return dict(row)
+    await db.commit()
+    return row
 
 
 async def get_balance(tg_id: int) -> int:
-    db = _conn()
-    cursor = await db.execute("SELECT balance FROM users WHERE tg_id = ?", (tg_id,))
-    row = await cursor.fetchone()
+    row = await _fetchone("SELECT balance FROM users WHERE tg_id = ?", (tg_id,))
     return row["balance"] if row else 0
 
 
 async def add_stars(tg_id: int, amount: int, details: str = "") -> int:
     """Add stars to user balance. Returns new balance."""
     db = _conn()
-    await db.execute("UPDATE users SET balance = balance + ? WHERE tg_id = ?", (amount, tg_id))
+    cursor = await db.execute(
+        "UPDATE users SET balance = balance + ? WHERE tg_id = ? RETURNING balance",
+        (amount, tg_id),
+    )
+    row = await cursor.fetchone()
     await db.execute(
         "INSERT INTO transactions (tg_id, type, amount, details) VALUES (?, 'buy', ?, ?)",
         (tg_id, amount, details),
     )
     await db.commit()
-    return await get_balance(tg_id)
+    return row["balance"] if row else 0
 
 
 async def gift_stars(tg_id: int, amount: int, gifted_by: str = "") -> int:
     """Gift stars to user (admin action). Returns new balance."""
     db = _conn()
-    await db.execute("UPDATE users SET balance = balance + ? WHERE tg_id = ?", (amount, tg_id))
+    cursor = await db.execute(
+        "UPDATE users SET balance = balance + ? WHERE tg_id = ? RETURNING balance",
+        (amount, tg_id),
+    )
+    row = await cursor.fetchone()
     await db.execute(
         "INSERT INTO transactions (tg_id, type, amount, details) VALUES (?, 'gift', ?, ?)",
         (tg_id, amount, f"gifted by {gifted_by}"),
     )
     await db.commit()
-    return await get_balance(tg_id)
+    return row["balance"] if row else 0
 
 
 async def spend_stars(tg_id: int, amount: int, details: str = "") -> int:
     """Deduct stars from user balance. Returns new balance."""
     db = _conn()
-    await db.execute("UPDATE users SET balance = balance - ? WHERE tg_id = ?", (amount, tg_id))
+    cursor = await db.execute(
+        "UPDATE users SET balance = balance - ? WHERE tg_id = ? RETURNING balance",
+        (amount, tg_id),
+    )
+    row = await cursor.fetchone()
     await db.execute(
         "INSERT INTO transactions (tg_id, type, amount, details) VALUES (?, 'spend', ?, ?)",
         (tg_id, amount, details),
     )
     await db.commit()
-    return await get_balance(tg_id)
+    return row["balance"] if row else 0
 
 
 async def set_format(tg_id: int, fmt: str) -> None:
@@ -118,48 +190,52 @@ async def set_format(tg_id: int, fmt: str) -> None:
 
 
 async def get_format(tg_id: int) -> str:
-    db = _conn()
-    cursor = await db.execute("SELECT format FROM users WHERE tg_id = ?", (tg_id,))
-    row = await cursor.fetchone()
+    row = await _fetchone("SELECT format FROM users WHERE tg_id = ?", (tg_id,))
     return row["format"] if row else "pdf"
 
 
-async def get_all_users() -> list[dict]:
-    db = _conn()
-    cursor = await db.execute("SELECT * FROM users ORDER BY created_at DESC")
-    rows = await cursor.fetchall()
-    return [dict(r) for r in rows]
+async def get_all_users() -> list[aiosqlite.Row]:
+    return await _fetchall("SELECT * FROM users ORDER BY created_at DESC")
 
 
-async def get_user_by_username(username: str) -> dict | None:
-    db = _conn()
-    cursor = await db.execute("SELECT * FROM users WHERE username = ?", (username,))
-    row = await cursor.fetchone()
-    return dict(row) if row else None
+async def get_user_by_username(username: str) -> aiosqlite.Row | None:
+    return await _fetchone("SELECT * FROM users WHERE username = ?", (username,))
 
 
 async def get_stats() -> dict:
     """Get bot statistics."""
-    db = _conn()
-    cursor = await db.execute("SELECT COUNT(*) as cnt FROM users")
-    users_count = (await cursor.fetchone())["cnt"]
-
-    cursor = await db.execute("SELECT COUNT(*) as cnt FROM transactions WHERE type = 'spend'")
-    translations_count = (await cursor.fetchone())["cnt"]
-
-    cursor = await db.execute("SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE type = 'buy'")
-    stars_bought = (await cursor.fetchone())["total"]
-
-    cursor = await db.execute("SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE type = 'spend'")
-    stars_spent = (await cursor.fetchone())["total"]
+    row = await _fetchone("""
+        SELECT
+            (SELECT COUNT(*) FROM users) AS users,
+            COALESCE(SUM(type = 'spend'), 0) AS translations,
+            COALESCE(SUM(CASE WHEN type = 'buy' THEN amount END), 0) AS stars_bought,
+            COALESCE(SUM(CASE WHEN type = 'spend' THEN amount END), 0) AS stars_spent,
+            COALESCE(SUM(CASE WHEN type = 'gift' THEN amount END), 0) AS stars_gifted
+        FROM transactions
+    """)
+    return dict(row)
 
-    cursor = await db.execute("SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE type = 'gift'")
-    stars_gifted = (await cursor.fetchone())["total"]
 
-    return {
-        "users": users_count,
-        "translations": translations_count,
-        "stars_bought": stars_bought,
-        "stars_spent": stars_spent,
-        "stars_gifted": stars_gifted,
-    }
+async def get_cached_translations(keys: list[str]) -> dict[str, str]:
+    """Return cached chunk translations for the given keys (missing keys are omitted)."""
+    found: dict[str, str] = {}
+    for start in range(0, len(keys), _CACHE_LOOKUP_BATCH):
+        batch = keys[start:start + _CACHE_LOOKUP_BATCH]
+        placeholders = ",".join("?" * len(batch))
+        rows = await _fetchall(
+            f"SELECT key, text FROM translation_cache WHERE key IN ({placeholders})",
+            tuple(batch),
+        )
+        found.update((row["key"], row["text"]) for row in rows)
+    return found
+
+
+async def save_translations(items: list[tuple[str, str]]) -> None:
+    """Store (key, text) chunk translations in one transaction."""
+    if not items:
+        return
+    db = _conn()
+    await db.executemany(
+        "INSERT OR REPLACE INTO translation_cache (key, text) VALUES (?, ?)", items
+    )
+    await db.commit()
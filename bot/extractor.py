@@ -1,10 +1,24 @@
+import functools
 import logging
+import multiprocessing
+import os
+import re
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
 from pathlib import Path
 import pymupdf4llm
 import fitz
+import ebooklib
 from ebooklib import epub
 import html2text
 
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
 logger = logging.getLogger(__name__)
 
 _h2t = html2text.HTML2Text()
@@ -12,6 +26,73 @@ _h2t.ignore_links = False
 _h2t.ignore_images = False
 _h2t.body_width = 0
 
+_MD_IMG_RE = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+
+# PDF extraction is split into page ranges across processes (PyMuPDF is not thread-safe)
+PDF_WORKERS = os.cpu_count() or 1
+_MIN_PAGES_PER_WORKER = 10
+
+
+@dataclass
+class Document:
+    """Metadata and parsed content of an input book, shared by the extract_* helpers."""
+
+    path: Path
+    ext: str
+    title: str
+    author: str
+    page_count: int
+    epub_book: epub.EpubBook | None = None
+
+
+def open_document(file_path: str | Path) -> Document:
+    """Open a PDF or EPUB; repeat calls for an unchanged file reuse the parsed result."""
+    file_path = Path(file_path)
+    st = file_path.stat()
+    return _open_document(str(file_path), st.st_mtime_ns, st.st_size)
+
+
+# A parsed EpubBook holds the whole book in memory and outlives its deleted job dir
+# until evicted, so only the last couple of uploads are kept
+@functools.lru_cache(maxsize=2)
+def _open_document(path: str, mtime_ns: int, size: int) -> Document:
+    file_path = Path(path)
+    ext = file_path.suffix.lower()
+
+    if ext == ".pdf":
+        doc = fitz.open(path)
+        try:
+            pdf_meta = doc.metadata or {}
+            return Document(
+                path=file_path,
+                ext=ext,
+                title=pdf_meta.get("title", "") or "",
+                author=pdf_meta.get("author", "") or "",
+                page_count=len(doc),
+            )
+        finally:
+            doc.close()
+
+    if ext == ".epub":
+        book = epub.read_epub(path, options={"ignore_ncx": True})
+        title_list = book.get_metadata("DC", "title")
+        creator_list = book.get_metadata("DC", "creator")
+        total_chars = 0
+        for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+            content = item.get_content().decode("utf-8", errors="ignore")
+            total_chars += len(content)
+        return Document(
+            path=file_path,
+            ext=ext,
+            title=title_list[0][0] if title_list else "",
+            author=creator_list[0][0] if creator_list else "",
+            # ~2000 chars per page estimate for EPUB
+            page_count=max(1, total_chars // 2000),
+            epub_book=book,
+        )
+
+    return Document(path=file_path, ext=ext, title="", author="", page_count=1)
+
 
 def extract_cover_image(file_path: str | Path, output_path: str | Path) -> Path | None:
     """Render first page of PDF as high-res PNG for use as cover."""
@@ -27,7 +108,7 @@ def extract_cover_image(file_path: str | Path, output_path: str | Path) -> Path
             doc.close()
             return None
         page = doc[0]
-        pix = page.get_pixmap(dpi=300)
+        pix = page.get_pixmap(dpi=300, alpha=False)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         pix.save(str(output_path))
         doc.close()
@@ -44,23 +125,13 @@ def extract_metadata(file_path: str | Path) -> dict[str, str]:
     ext = file_path.suffix.lower()
     meta = {"title": "", "author": ""}
 
-    try:
-        if ext == ".pdf":
-            doc = fitz.open(str(file_path))
-            pdf_meta = doc.metadata or {}
-            meta["title"] = pdf_meta.get("title", "") or ""
-            meta["author"] = pdf_meta.get("author", "") or ""
-            doc.close()
-        elif ext == ".epub":
-            book = epub.read_epub(str(file_path), options={"ignore_ncx": True})
-            title_list = book.get_metadata("DC", "title")
-            if title_list:
-                meta["title"] = title_list[0][0]
-            creator_list = book.get_metadata("DC", "creator")
-            if creator_list:
-                meta["author"] = creator_list[0][0]
-    except Exception as e:
-        logger.warning("Failed to extract metadata: %s", e)
+    if ext in (".pdf", ".epub"):
+        try:
+            doc = open_document(file_path)
+            meta["title"] = doc.title
+            meta["author"] = doc.author
+        except Exception as e:
+            logger.warning("Failed to extract metadata: %s", e)
 
     # Fallback: use filename as title
     if not meta["title"]:
@@ -92,23 +163,18 @@ def extract_to_markdown(
 
 def count_pages(file_path: str | Path) -> int:
     """Count pages in PDF or estimated pages in EPUB."""
-    file_path = Path(file_path)
-    ext = file_path.suffix.lower()
+    return open_document(file_path).page_count
 
-    if ext == ".pdf":
-        doc = fitz.open(str(file_path))
-        count = len(doc)
+
+def count_pages_bytes(data: bytes | memoryview, ext: str) -> int:
+    """Count pages in a PDF held in memory."""
+    if ext != ".pdf":
+        raise ValueError(f"In-memory page count is only supported for PDF, got {ext!r}")
+    doc = fitz.open(stream=data, filetype="pdf")
+    try:
+        return len(doc)
+    finally:
         doc.close()
-        return count
-    elif ext == ".epub":
-        book = epub.read_epub(str(file_path), options={"ignore_ncx": True})
-        total_chars = 0
-        for item in book.get_items_of_type(9):
-            content = item.get_content().decode("utf-8", errors="ignore")
-            total_chars += len(content)
-        # ~2000 chars per page estimate for EPUB
-        return max(1, total_chars // 2000)
-    return 1
 
 
 def _extract_pdf(
@@ -124,21 +190,38 @@ def _extract_pdf(
         "dpi": 150,
     }
 
-    if skip_first_page:
-        doc = fitz.open(str(pdf_path))
-        total = len(doc)
-        doc.close()
-        if total > 1:
-            kwargs["pages"] = list(range(1, total))
+    total = open_document(pdf_path).page_count
+    first = 1 if skip_first_page and total > 1 else 0
+    pages = list(range(first, total))
 
     if image_dir:
+        # Image names include the page number, so workers never write the same file
         kwargs["write_images"] = True
         kwargs["image_path"] = str(image_dir)
         kwargs["image_format"] = "png"
         kwargs["image_size_limit"] = 0.03
         logger.info("Saving images to: %s", image_dir)
 
-    md_text = pymupdf4llm.to_markdown(str(pdf_path), **kwargs)
+    workers = min(PDF_WORKERS, len(pages) // _MIN_PAGES_PER_WORKER)
+    if workers > 1:
+        # Font-size header levels are detected over the whole book up front so all ranges agree.
+        # Releases built on pymupdf_layout (1.28+) drop IdentifyHeaders: there each range gets
+        # its levels from the layout model, so a heading may come out one level off across ranges
+        identify_headers = getattr(pymupdf4llm, "IdentifyHeaders", None)
+        if identify_headers:
+            kwargs["hdr_info"] = identify_headers(str(pdf_path), pages=pages)
+        step = -(-len(pages) // workers)
+        ranges = [pages[i:i + step] for i in range(0, len(pages), step)]
+        logger.info("Extracting %d pages in %d processes", len(pages), len(ranges))
+        # "spawn": the bot process runs aiosqlite and executor threads that fork would copy mid-lock
+        with ProcessPoolExecutor(
+            max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            md_text = "".join(
+                pool.map(_pdf_pages_to_markdown, repeat(str(pdf_path)), ranges, repeat(kwargs))
+            )
+    else:
+        md_text = _pdf_pages_to_markdown(str(pdf_path), pages, kwargs)
 
     if image_dir:
         md_text = _normalize_image_paths(md_text, image_dir)
@@ -147,32 +230,41 @@ def _extract_pdf(
     return md_text
 
 
+def _pdf_pages_to_markdown(pdf_path: str, pages: list[int], kwargs: dict) -> str:
+    return pymupdf4llm.to_markdown(pdf_path, pages=pages, **kwargs)
+
+
 def _extract_epub(epub_path: Path, image_dir: Path | None = None) -> str:
     logger.info("Extracting EPUB: %s", epub_path)
-    book = epub.read_epub(str(epub_path), options={"ignore_ncx": True})
+    book = open_document(epub_path).epub_book
 
     # Extract images from EPUB
     image_map: dict[str, str] = {}
     if image_dir:
         image_dir.mkdir(parents=True, exist_ok=True)
         for item in book.get_items():
-            if item.get_type() == 3:  # ITEM_IMAGE
-                img_name = Path(item.get_name()).name
+            # EPUB 3 readers load the "cover-image" item as ITEM_COVER
+            if item.get_type() in (ebooklib.ITEM_IMAGE, ebooklib.ITEM_COVER):
+                name = item.get_name()
+                img_name = Path(name).name
                 img_path = image_dir / img_name
                 img_path.write_bytes(item.get_content())
                 # Map original EPUB path to local path
-                image_map[item.get_name()] = str(img_path)
+                image_map[name] = str(img_path)
                 logger.info("Extracted EPUB image: %s", img_name)
 
+    # One pattern for the whole book, applied once per document
+    rewrite_src = _epub_src_rewriter(image_map)
+
     parts: list[str] = []
-    for item in book.get_items_of_type(9):
+    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
         html_content = item.get_content().decode("utf-8", errors="ignore")
 
         # Rewrite image src paths to local extracted files
-        if image_dir:
-            html_content = _rewrite_epub_image_paths(html_content, image_map, image_dir)
+        if rewrite_src:
+            html_content = rewrite_src(html_content)
 
-        md = _h2t.handle(html_content).strip()
+        md = _html_to_md(html_content)
         if md:
             parts.append(md)
 
@@ -183,7 +275,6 @@ def _extract_epub(epub_path: Path, image_dir: Path | None = None) -> str:
 
 def _normalize_image_paths(md_text: str, image_dir: Path) -> str:
     """Ensure image paths in markdown are absolute for WeasyPrint/EPUB generation."""
-    import re
     abs_dir = str(image_dir.resolve())
 
     def _fix_path(m: re.Match) -> str:
@@ -196,22 +287,180 @@ def _normalize_image_paths(md_text: str, image_dir: Path) -> str:
         abs_path = str((image_dir / Path(path).name).resolve())
         return f"![{alt}]({abs_path})"
 
-    return re.sub(r'!\[([^\]]*)\]\(([^)]+)\)', _fix_path, md_text)
+    return _MD_IMG_RE.sub(_fix_path, md_text)
 
 
-def _rewrite_epub_image_paths(
-    html_content: str,
-    image_map: dict[str, str],
-    image_dir: Path,
-) -> str:
-    """Replace EPUB image references with local file paths."""
-    import re
-    for epub_path, local_path in image_map.items():
-        # Match various src patterns: relative, with ../, just filename
-        epub_name = Path(epub_path).name
-        html_content = re.sub(
-            rf'(src=["\'])([^"\']*{re.escape(epub_name)})',
-            rf'\g<1>{local_path}',
-            html_content,
-        )
-    return html_content
+def _epub_src_rewriter(image_map: dict[str, str]) -> Callable[[str], str] | None:
+    """Build a function replacing EPUB image references with local file paths."""
+    if not image_map:
+        return None
+    # Match various src patterns (relative, with ../, just filename) for all images at once
+    local_by_name = {Path(epub_path).name: local_path for epub_path, local_path in image_map.items()}
+    names = "|".join(re.escape(name) for name in local_by_name)
+    # The name must follow a "/" or the quote, so "pic.png" doesn't match inside "mypic.png"
+    pattern = re.compile(rf'(src=["\'])(?:[^"\']*/)?({names})(?=["\'])')
+    return functools.partial(pattern.sub, lambda m: m.group(1) + local_by_name[m.group(2)])
+
+
+# ---------------------------------------------------------------------------
+# HTML -> Markdown (lexbor-backed, html2text fallback)
+# ---------------------------------------------------------------------------
+
+_WS_RE = re.compile(r"\s+")
+# Escaping as html2text does it, so text is never read back as markup
+_MD_INLINE_CHARS_RE = re.compile(r"([\\`*_\[\]])")
+_MD_LINE_START_RE = re.compile(r"^([ \t]*)(#|>|[-+](?=\s|-|$))", re.MULTILINE)
+_MD_ORDERED_RE = re.compile(r"^([ \t]*\d+)\.(?=\s|$)", re.MULTILINE)
+_HEADING_LEVELS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+_SKIP_TAGS = {"-comment", "head", "script", "style", "title", "meta", "link"}
+_CONTAINER_TAGS = {
+    "html", "body", "div", "section", "article", "main", "header", "footer",
+    "aside", "nav", "figure", "figcaption", "center",
+}
+_BLOCK_TAGS = {"p", "ul", "ol", "blockquote", "pre", "hr", "table"} | set(_HEADING_LEVELS) | _CONTAINER_TAGS
+
+
+def _html_to_md(html_content: str) -> str:
+    """Convert an EPUB document to Markdown, using lexbor when available."""
+    if LexborHTMLParser is not None:
+        try:
+            tree = LexborHTMLParser(html_content)
+            root = tree.body or tree.root
+            if root is None:
+                return ""
+            return "\n\n".join(_md_blocks(root)).strip()
+        except Exception as e:
+            logger.warning("lexbor conversion failed, falling back to html2text: %s", e)
+    return _h2t.handle(html_content).strip()
+
+
+def _md_blocks(node) -> list[str]:
+    """Render the children of a block-level node as a list of Markdown blocks."""
+    blocks: list[str] = []
+    run: list[str] = []
+
+    def _flush() -> None:
+        text = _escape_line_starts("".join(run).strip())
+        run.clear()
+        if text:
+            blocks.append(text)
+
+    for child in node.iter(include_text=True):
+        tag = child.tag
+        if tag in _SKIP_TAGS:
+            continue
+        if tag not in _BLOCK_TAGS:
+            run.append(_md_inline(child))
+            continue
+
+        _flush()
+        if tag in _HEADING_LEVELS:
+            text = _md_inline_children(child).strip()
+            if text:
+                blocks.append("#" * _HEADING_LEVELS[tag] + " " + text)
+        elif tag == "p":
+            text = _escape_line_starts(_md_inline_children(child).strip())
+            if text:
+                blocks.append(text)
+        elif tag in ("ul", "ol"):
+            items = _md_list(child, ordered=(tag == "ol"))
+            if items:
+                blocks.append(items)
+        elif tag == "blockquote":
+            inner = "\n\n".join(_md_blocks(child))
+            if inner:
+                blocks.append("\n".join(f"> {line}".rstrip() for line in inner.split("\n")))
+        elif tag == "pre":
+            code = child.text(deep=True).strip("\n")
+            if code:
+                blocks.append(f"```\n{code}\n```")
+        elif tag == "hr":
+            blocks.append("* * *")
+        elif tag == "table":
+            table = _md_table(child)
+            if table:
+                blocks.append(table)
+        else:
+            blocks.extend(_md_blocks(child))
+    _flush()
+    return blocks
+
+
+def _md_list(node, ordered: bool) -> str:
+    lines: list[str] = []
+    number = 1
+    for li in node.iter():
+        if li.tag != "li":
+            continue
+        marker = f"{number}. " if ordered else "* "
+        number += 1
+        body = "\n".join(_md_blocks(li)).split("\n")
+        lines.append(marker + body[0])
+        # Continuation lines (nested lists, extra paragraphs) are indented under the marker
+        lines.extend(" " * len(marker) + line if line else "" for line in body[1:])
+    return "\n".join(lines)
+
+
+def _md_table(node) -> str:
+    rows: list[list[str]] = []
+    for tr in node.css("tr"):
+        cells = [
+            _md_inline_children(cell).strip().replace("|", "\\|")
+            for cell in tr.iter()
+            if cell.tag in ("td", "th")
+        ]
+        if cells:
+            rows.append(cells)
+    if not rows:
+        return ""
+    lines = ["| " + " | ".join(row) + " |" for row in rows]
+    lines.insert(1, "|" + " --- |" * len(rows[0]))
+    return "\n".join(lines)
+
+
+def _md_inline_children(node) -> str:
+    return "".join(_md_inline(child) for child in node.iter(include_text=True))
+
+
+def _md_inline(node) -> str:
+    """Render a single inline node (text, emphasis, link, image...) as Markdown."""
+    tag = node.tag
+    if tag == "-text":
+        return _MD_INLINE_CHARS_RE.sub(r"\\\1", _WS_RE.sub(" ", node.text_content or ""))
+    if tag in _SKIP_TAGS:
+        return ""
+    if tag in ("strong", "b"):
+        return _md_wrap(_md_inline_children(node), "**")
+    if tag in ("em", "i"):
+        return _md_wrap(_md_inline_children(node), "*")
+    if tag == "code":
+        return _md_wrap(node.text(deep=True), "`")
+    if tag == "br":
+        return "  \n"
+    if tag == "img":
+        src = node.attributes.get("src") or ""
+        alt = node.attributes.get("alt") or ""
+        return f"![{alt}]({src})" if src else ""
+    if tag == "a":
+        text = _md_inline_children(node)
+        href = node.attributes.get("href")
+        if not href or not text.strip():
+            return text
+        return _md_wrap(text, "[", f"]({href})")
+    return _md_inline_children(node)
+
+
+def _escape_line_starts(text: str) -> str:
+    """Escape text that would open a heading, quote or list at the start of a line."""
+    text = _MD_LINE_START_RE.sub(r"\1\\\2", text)
+    return _MD_ORDERED_RE.sub(r"\1\\.", text)
+
+
+def _md_wrap(text: str, start: str, end: str | None = None) -> str:
+    """Wrap text in Markdown markers, keeping surrounding whitespace outside them."""
+    core = text.strip()
+    if not core:
+        return text
+    lead = " " if text[0].isspace() else ""
+    trail = " " if text[-1].isspace() else ""
+    return f"{lead}{start}{core}{start if end is None else end}{trail}"
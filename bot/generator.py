@@ -1,5 +1,10 @@
+import asyncio
+import functools
 import logging
+import multiprocessing
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import markdown as md_lib
 from weasyprint import HTML
@@ -11,7 +16,20 @@ logger = logging.getLogger(__name__)
 BOT_LINK = "https://t.me/tg_transbooks_bot"
 BOT_HANDLE = "@tg_transbooks_bot"
 
+_HEADING_RE = re.compile(r"^#{1,2}\s+")
+_CHAPTER_SPLIT_RE = re.compile(r"^(#{1,2}[^\S\n]+.*)$", re.MULTILINE)
+_MD_IMG_SRC_RE = re.compile(r'!\[[^\]]*\]\(([^)]+)\)')
 
+# WeasyPrint layout and EPUB assembly are pure Python and hold the GIL, so they run in
+# worker processes; half the cores leaves room for the bot and PDF extraction.
+# "spawn" keeps workers clear of locks held by the bot's threads at fork time.
+_RENDER_POOL = ProcessPoolExecutor(
+    max_workers=max(1, (os.cpu_count() or 2) // 2),
+    mp_context=multiprocessing.get_context("spawn"),
+)
+
+
+@functools.lru_cache(maxsize=1)
 def _load_css() -> str:
     css_path = TEMPLATES_DIR / "book.css"
     if css_path.exists():
@@ -30,12 +48,17 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </body>
 </html>"""
 
+_CHAPTER_WRAP = "<html><body>{}</body></html>".format
 
-def _md_to_html(md_text: str) -> str:
-    return md_lib.markdown(
-        md_text,
-        extensions=["tables", "fenced_code", "toc"],
-    )
+
+_MD_EXTENSIONS = ["tables", "fenced_code", "toc"]
+
+
+def _md_to_html(md_text: str, converter: md_lib.Markdown | None = None) -> str:
+    """Convert Markdown to HTML, reusing `converter` (reset between documents) when given."""
+    if converter is None:
+        converter = md_lib.Markdown(extensions=_MD_EXTENSIONS)
+    return converter.reset().convert(md_text)
 
 
 # ---------------------------------------------------------------------------
@@ -55,6 +78,7 @@ def _title_page_html(title: str, author: str) -> str:
     )
 
 
+@functools.lru_cache(maxsize=1)
 def _colophon_html() -> str:
     return (
         '<div class="colophon">'
@@ -83,7 +107,7 @@ def _cover_page_html(cover_image_path: Path) -> str:
 # PDF generation
 # ---------------------------------------------------------------------------
 
-def markdown_to_pdf(
+async def markdown_to_pdf(
     md_text: str,
     output_path: str | Path,
     image_dir: Path | None = None,
@@ -115,6 +139,17 @@ def markdown_to_pdf(
 
     base_url = str(image_dir.resolve()) + "/" if image_dir else None
 
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        _RENDER_POOL, _render_pdf, full_html, base_url, str(output_path), title, author,
+    )
+
+    logger.info("PDF generated: %s (%d bytes)", output_path, output_path.stat().st_size)
+    return output_path
+
+
+def _render_pdf(full_html: str, base_url: str | None, output_path: str, title: str, author: str) -> None:
+    """Lay out and write the PDF (runs in a _RENDER_POOL worker process)."""
     weasy_doc = HTML(string=full_html, base_url=base_url).render()
 
     # Set PDF metadata
@@ -125,28 +160,49 @@ def markdown_to_pdf(
         metadata.authors = [author]
     metadata.generator = f"TransBooks Bot ({BOT_HANDLE})"
 
-    weasy_doc.write_pdf(str(output_path))
-
-    logger.info("PDF generated: %s (%d bytes)", output_path, output_path.stat().st_size)
-    return output_path
+    weasy_doc.write_pdf(output_path)
 
 
 # ---------------------------------------------------------------------------
 # EPUB generation
 # ---------------------------------------------------------------------------
 
-def markdown_to_epub(
+async def markdown_to_epub(
     md_text: str,
     output_path: str | Path,
     title: str = "Перевод",
     author: str = "",
     image_dir: Path | None = None,
     cover_image_path: Path | None = None,
+    cover_image_bytes: bytes | None = None,
 ) -> Path:
-    """Convert Markdown text to an EPUB file with cover, metadata, and colophon."""
+    """Convert Markdown text to an EPUB file with cover, metadata, and colophon.
+
+    The cover can be given as a PNG file or, to skip a disk round trip, as PNG bytes.
+    """
     output_path = Path(output_path)
     logger.info("Generating EPUB: %s", output_path)
 
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        _RENDER_POOL, _build_epub, md_text, output_path, title, author,
+        image_dir, cover_image_path, cover_image_bytes,
+    )
+
+    logger.info("EPUB generated: %s (%d bytes)", output_path, output_path.stat().st_size)
+    return output_path
+
+
+def _build_epub(
+    md_text: str,
+    output_path: Path,
+    title: str,
+    author: str,
+    image_dir: Path | None,
+    cover_image_path: Path | None,
+    cover_image_bytes: bytes | None,
+) -> None:
+    """Assemble and write the EPUB (runs in a _RENDER_POOL worker process)."""
     book = epub.EpubBook()
     book.set_identifier("transbooks-bot-translation")
     book.set_title(title)
@@ -168,16 +224,21 @@ def markdown_to_epub(
     book.add_item(style)
 
     # Set cover image
-    if cover_image_path and cover_image_path.exists():
-        cover_data = cover_image_path.read_bytes()
-        book.set_cover("cover.png", cover_data, create_page=True)
-        logger.info("EPUB cover set from: %s", cover_image_path)
+    if cover_image_bytes is None and cover_image_path and cover_image_path.exists():
+        cover_image_bytes = cover_image_path.read_bytes()
+        logger.info("EPUB cover read from: %s", cover_image_path)
+    if cover_image_bytes:
+        book.set_cover("cover.png", cover_image_bytes, create_page=True)
 
-    # Collect and embed content images
+    # Collect and embed content images the text actually references
     image_items: dict[str, str] = {}
     if image_dir and image_dir.exists():
+        referenced = set(_MD_IMG_SRC_RE.findall(md_text))
         for img_file in sorted(image_dir.iterdir()):
-            if img_file.suffix.lower() in (".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp"):
+            if (
+                img_file.suffix.lower() in (".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp")
+                and str(img_file.resolve()) in referenced
+            ):
                 epub_img_path = f"images/{img_file.name}"
                 media_type = _guess_media_type(img_file.suffix)
                 img_item = epub.EpubItem(
@@ -197,13 +258,15 @@ def markdown_to_epub(
     chapters = _split_into_chapters(md_text)
     spine = ["nav"]
     toc = []
+    # Building the extension pipeline is the expensive part; do it once per book
+    converter = md_lib.Markdown(extensions=_MD_EXTENSIONS)
 
     for i, (ch_title, ch_md) in enumerate(chapters):
-        html_content = _md_to_html(ch_md)
+        html_content = _md_to_html(ch_md, converter)
         ch = epub.EpubHtml(
             title=ch_title, file_name=f"chapter_{i}.xhtml", lang="ru",
         )
-        ch.content = f"<html><body>{html_content}</body></html>"
+        ch.content = _CHAPTER_WRAP(html_content)
         ch.add_item(style)
         book.add_item(ch)
         spine.append(ch)
@@ -213,7 +276,7 @@ def markdown_to_epub(
     colophon_ch = epub.EpubHtml(
         title="О переводе", file_name="colophon.xhtml", lang="ru",
     )
-    colophon_ch.content = f"<html><body>{_colophon_html()}</body></html>"
+    colophon_ch.content = _CHAPTER_WRAP(_colophon_html())
     colophon_ch.add_item(style)
     book.add_item(colophon_ch)
     spine.append(colophon_ch)
@@ -225,15 +288,13 @@ def markdown_to_epub(
 
     epub.write_epub(str(output_path), book)
 
-    logger.info("EPUB generated: %s (%d bytes)", output_path, output_path.stat().st_size)
-    return output_path
-
 
 def _rewrite_paths_for_epub(md_text: str, image_items: dict[str, str]) -> str:
     """Replace absolute image paths with EPUB-relative paths."""
-    for abs_path, epub_path in image_items.items():
-        md_text = md_text.replace(abs_path, epub_path)
-    return md_text
+    # Longest first so a path that prefixes another never wins the alternation
+    paths = sorted(image_items, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(p) for p in paths))
+    return pattern.sub(lambda m: image_items[m.group(0)], md_text)
 
 
 def _guess_media_type(suffix: str) -> str:
@@ -249,21 +310,14 @@ def _guess_media_type(suffix: str) -> str:
 
 def _split_into_chapters(md_text: str) -> list[tuple[str, str]]:
     """Split markdown by H1/H2 headings into (title, content) pairs."""
-    lines = md_text.split("\n")
+    # [preface, heading1, body1, heading2, body2, ...]
+    parts = _CHAPTER_SPLIT_RE.split(md_text)
     chapters: list[tuple[str, str]] = []
-    current_title = "Начало"
-    current_lines: list[str] = []
-
-    for line in lines:
-        if re.match(r"^#{1,2}\s+", line):
-            if current_lines:
-                chapters.append((current_title, "\n".join(current_lines)))
-            current_title = re.sub(r"^#{1,2}\s+", "", line).strip()
-            current_lines = [line]
-        else:
-            current_lines.append(line)
-
-    if current_lines:
-        chapters.append((current_title, "\n".join(current_lines)))
+
+    if parts[0].strip():
+        chapters.append(("Начало", parts[0]))
+    for i in range(1, len(parts), 2):
+        title = _HEADING_RE.sub("", parts[i]).strip()
+        chapters.append((title, parts[i] + parts[i + 1]))
 
     return chapters if chapters else [("Перевод", md_text)]
@@ -1,6 +1,12 @@
+import asyncio
+import functools
+import hashlib
+import io
 import logging
-import math
+import shutil
+import time
 import uuid
+from datetime import timedelta
 from pathlib import Path
 
 from telegram import (
@@ -8,6 +14,7 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     BotCommand,
+    InputFile,
     LabeledPrice,
 )
 from telegram.ext import (
@@ -19,21 +26,38 @@ from telegram.ext import (
     filters,
     Application,
 )
+from telegram.error import RetryAfter
+from cachetools import TTLCache
 
-from bot.config import MAX_FILE_SIZE_MB, TMP_DIR, ADMIN_USERNAME, STARS_PER_50_PAGES
+from bot.config import (
+    MAX_FILE_SIZE_MB, DATA_DIR, TMP_DIR, ADMIN_USERNAME, STARS_PER_50_PAGES,
+    JOB_TTL_SECONDS,
+)
 from bot.database import (
     get_or_create_user, get_balance, add_stars, gift_stars,
     spend_stars, set_format, get_format, get_all_users,
     get_user_by_username, get_stats, init_db,
 )
-from bot.extractor import extract_to_markdown, count_pages, extract_cover_image, extract_metadata
-from bot.translator import translate_markdown, translate_chunk
+from bot.extractor import (
+    extract_to_markdown, count_pages, count_pages_bytes, extract_cover_image, extract_metadata,
+)
+from bot.translator import translate_markdown, translate_chunk, TranslationCancelled, load_tokenizer
 from bot.generator import markdown_to_pdf, markdown_to_epub
-from bot.cover import generate_cover
+from bot.cover import generate_cover_bytes
 
 logger = logging.getLogger(__name__)
 
-active_jobs: dict[int, bool] = {}
+# Running translations: user_id -> cancel event
+active_jobs: dict[int, asyncio.Event] = {}
+
+# How often expired jobs are swept even when no new jobs arrive
+JOB_SWEEP_INTERVAL = 300
+
+# PDFs up to this size are analyzed in memory and only written to disk once the job is accepted
+IN_MEMORY_MAX_MB = MAX_FILE_SIZE_MB / 2
+
+# Minimum seconds between translation progress edits of the status message
+PROGRESS_EDIT_INTERVAL = 2.0
 
 # Star packages available for purchase
 STAR_PACKAGES = [
@@ -46,7 +70,8 @@ STAR_PACKAGES = [
 
 def _calc_cost(pages: int) -> int:
     """Calculate star cost for given page count."""
-    return max(1, math.ceil(pages / 50 * STARS_PER_50_PAGES))
+    # Integer ceil(pages * STARS_PER_50_PAGES / 50): keep it free of float math
+    return max(1, (pages * STARS_PER_50_PAGES + 49) // 50)
 
 
 def _is_admin(user) -> bool:
@@ -54,7 +79,9 @@ def _is_admin(user) -> bool:
 
 
 # --- Keyboards ---
+# Markups are immutable, so identical keyboards are built once and shared
 
+@functools.lru_cache(maxsize=512)
 def _main_kb(balance: int, fmt: str, is_admin: bool = False) -> InlineKeyboardMarkup:
     fmt_label = fmt.upper()
     rows = [
@@ -72,6 +99,7 @@ def _main_kb(balance: int, fmt: str, is_admin: bool = False) -> InlineKeyboardMa
     return InlineKeyboardMarkup(rows)
 
 
+@functools.lru_cache(maxsize=1)
 def _buy_kb() -> InlineKeyboardMarkup:
     buttons = [
         [InlineKeyboardButton(label, callback_data=f"pack_{amount}")]
@@ -81,6 +109,7 @@ def _buy_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
+@functools.lru_cache(maxsize=2)
 def _format_kb(current: str) -> InlineKeyboardMarkup:
     pdf_l = "📄 PDF ✅" if current == "pdf" else "📄 PDF"
     epub_l = "📱 EPUB ✅" if current == "epub" else "📱 EPUB"
@@ -102,12 +131,14 @@ def _confirm_kb(job_id: str) -> InlineKeyboardMarkup:
     ])
 
 
+@functools.lru_cache(maxsize=1)
 def _cancel_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🛑 Отменить перевод", callback_data="cancel")]
     ])
 
 
+@functools.lru_cache(maxsize=1)
 def _admin_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💰 Начислить звёзды", callback_data="admin_gift")],
@@ -128,6 +159,30 @@ def _welcome_text(balance: int) -> str:
     )
 
 
+_HELP_TEXT = (
+    "📖 *Переводчик книг EN→RU*\n\n"
+    "*Как пользоваться:*\n"
+    "1. Купи звёзды кнопкой 💫\n"
+    "2. Отправь PDF или EPUB файл\n"
+    "3. Подтверди перевод\n"
+    "4. Получи переведённый файл\n\n"
+    f"💰 {STARS_PER_50_PAGES} ⭐ ≈ 50 страниц\n"
+    f"📏 Макс. размер: {MAX_FILE_SIZE_MB} МБ"
+)
+
+_HELP_MENU_TEXT = (
+    "📖 *Переводчик книг EN→RU*\n\n"
+    "Принимаю: PDF, EPUB\n"
+    "Выдаю: PDF или EPUB\n\n"
+    "*Как пользоваться:*\n"
+    "1. Купи звёзды 💫\n"
+    "2. Отправь файл (PDF/EPUB)\n"
+    "3. Подтверди и получи перевод\n\n"
+    f"💰 {STARS_PER_50_PAGES} ⭐ ≈ 50 страниц\n"
+    f"📏 Макс: {MAX_FILE_SIZE_MB} МБ"
+)
+
+
 # --- Command handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -150,14 +205,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     user = update.effective_user
     u = await get_or_create_user(user.id, user.username or "")
     await update.message.reply_text(
-        "📖 *Переводчик книг EN→RU*\n\n"
-        "*Как пользоваться:*\n"
-        "1. Купи звёзды кнопкой 💫\n"
-        "2. Отправь PDF или EPUB файл\n"
-        "3. Подтверди перевод\n"
-        "4. Получи переведённый файл\n\n"
-        f"💰 {STARS_PER_50_PAGES} ⭐ ≈ 50 страниц\n"
-        f"📏 Макс. размер: {MAX_FILE_SIZE_MB} МБ",
+        _HELP_TEXT,
         parse_mode="Markdown",
         reply_markup=_main_kb(u["balance"], u["format"], _is_admin(user)),
     )
@@ -166,9 +214,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.effective_user:
         return
-    user_id = update.effective_user.id
-    if user_id in active_jobs:
-        active_jobs[user_id] = True
+    cancel_event = active_jobs.get(update.effective_user.id)
+    if cancel_event:
+        cancel_event.set()
         await update.message.reply_text("🛑 Отменяю перевод...")
     else:
         await update.message.reply_text("ℹ️ Нет активного перевода.")
@@ -185,8 +233,24 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # --- Callback query handler ---
 
+class _PendingJobs(TTLCache):
+    """TTLCache that removes a job's directory when the job expires or is evicted unconfirmed."""
+
+    def popitem(self):
+        job_id, job = super().popitem()
+        _cleanup_soon(Path(job["input_path"]).parent)
+        return job_id, job
+
+    def expire(self, time=None):
+        # Returns the expired (key, value) pairs since cachetools 5.5; __setitem__ calls it too
+        expired = super().expire(time)
+        for _, job in expired:
+            _cleanup_soon(Path(job["input_path"]).parent)
+        return expired
+
+
 # Pending jobs: job_id -> {user_id, input_path, pages, cost, filename, status_msg}
-pending_jobs: dict[str, dict] = {}
+pending_jobs: _PendingJobs = _PendingJobs(maxsize=10_000, ttl=JOB_TTL_SECONDS)
 
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -198,11 +262,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = user.id
     data = query.data
 
+    # Fetched once per callback: balance and format are read from this row below
     u = await get_or_create_user(user_id, user.username or "")
 
     # --- Main menu ---
     if data == "back_main":
-        u = await get_or_create_user(user_id, user.username or "")
         await query.edit_message_text(
             _welcome_text(u["balance"]),
             parse_mode="Markdown",
@@ -210,7 +274,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
 
     elif data == "balance":
-        balance = await get_balance(user_id)
+        balance = u["balance"]
         await query.edit_message_text(
             f"💰 *Твой баланс:* {balance} ⭐\n\n"
             f"Этого хватит на ~{balance * 50 // max(STARS_PER_50_PAGES, 1)} страниц.",
@@ -251,7 +315,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(
             "✅ Формат: *PDF*",
             parse_mode="Markdown",
-            reply_markup=_main_kb(await get_balance(user_id), "pdf", _is_admin(user)),
+            reply_markup=_main_kb(u["balance"], "pdf", _is_admin(user)),
         )
 
     elif data == "fmt_epub":
@@ -259,29 +323,22 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(
             "✅ Формат: *EPUB*",
             parse_mode="Markdown",
-            reply_markup=_main_kb(await get_balance(user_id), "epub", _is_admin(user)),
+            reply_markup=_main_kb(u["balance"], "epub", _is_admin(user)),
         )
 
     # --- Help ---
     elif data == "help":
         await query.edit_message_text(
-            "📖 *Переводчик книг EN→RU*\n\n"
-            "Принимаю: PDF, EPUB\n"
-            "Выдаю: PDF или EPUB\n\n"
-            "*Как пользоваться:*\n"
-            "1. Купи звёзды 💫\n"
-            "2. Отправь файл (PDF/EPUB)\n"
-            "3. Подтверди и получи перевод\n\n"
-            f"💰 {STARS_PER_50_PAGES} ⭐ ≈ 50 страниц\n"
-            f"📏 Макс: {MAX_FILE_SIZE_MB} МБ",
+            _HELP_MENU_TEXT,
             parse_mode="Markdown",
             reply_markup=_main_kb(u["balance"], u["format"], _is_admin(user)),
         )
 
     # --- Cancel ---
     elif data == "cancel":
-        if user_id in active_jobs:
-            active_jobs[user_id] = True
+        cancel_event = active_jobs.get(user_id)
+        if cancel_event:
+            cancel_event.set()
             await query.edit_message_text("🛑 Отменяю перевод...")
         else:
             await query.edit_message_text("ℹ️ Нет активного перевода.")
@@ -290,8 +347,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Cancel pending unconfirmed job
         to_remove = [jid for jid, j in pending_jobs.items() if j["user_id"] == user_id]
         for jid in to_remove:
-            _cleanup(Path(pending_jobs[jid]["input_path"]).parent)
-            del pending_jobs[jid]
+            job = pending_jobs.pop(jid, None)
+            if job:
+                await _cleanup(Path(job["input_path"]).parent)
         await query.edit_message_text("❌ Отменено.")
 
     # --- Confirm translation ---
@@ -422,9 +480,16 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     try:
         tg_file = await document.get_file()
-        await tg_file.download_to_drive(str(input_file))
-
-        pages = count_pages(input_file)
+        buf: io.BytesIO | None = None
+        if ext == ".pdf" and file_size_mb <= IN_MEMORY_MAX_MB:
+            buf = io.BytesIO()
+            await tg_file.download_to_memory(buf)
+            # Read through a view instead of copying the download; released before the file write
+            with buf.getbuffer() as view:
+                pages = count_pages_bytes(view, ext)
+        else:
+            await tg_file.download_to_drive(str(input_file))
+            pages = count_pages(input_file)
         cost = _calc_cost(pages)
         balance = await get_balance(user.id)
 
@@ -439,9 +504,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 parse_mode="Markdown",
                 reply_markup=_buy_kb(),
             )
-            _cleanup(job_dir)
+            await _cleanup(job_dir)
             return
 
+        if buf is not None:
+            await asyncio.to_thread(input_file.write_bytes, buf.getbuffer())
+
         pending_jobs[job_id] = {
             "user_id": user.id,
             "input_path": str(input_file),
@@ -463,7 +531,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception as e:
         logger.exception("Error analyzing file for user %s", user.id)
         await status_msg.edit_text(f"❌ Ошибка: {e}")
-        _cleanup(job_dir)
+        await _cleanup(job_dir)
 
 
 async def _run_translation(user, job: dict, message, context) -> None:
@@ -526,22 +594,37 @@ async def _run_translation(user, job: dict, message, context) -> None:
             reply_markup=_cancel_kb(),
         )
 
-        active_jobs[user_id] = False
+        cancel_event = asyncio.Event()
+        active_jobs[user_id] = cancel_event
+        last_pct = -1
+        next_edit_at = 0.0
 
         async def on_progress(done: int, total: int) -> None:
-            if active_jobs.get(user_id):
-                raise RuntimeError("Перевод отменён")
-            pct = int(done / total * 100)
+            nonlocal last_pct, next_edit_at
+            pct = done * 100 // total
+            now = time.monotonic()
+            if pct == last_pct or now < next_edit_at:
+                return
+            # Claim the slot before awaiting so concurrent chunks don't edit too
+            last_pct = pct
+            next_edit_at = now + PROGRESS_EDIT_INTERVAL
             try:
                 await status_msg.edit_text(
                     f"🌐 Перевожу... {pct}% ({done}/{total})",
                     reply_markup=_cancel_kb(),
                 )
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                next_edit_at = time.monotonic() + retry_after
             except Exception:
                 pass
 
         try:
-            translated_md = await translate_markdown(md_text, progress_callback=on_progress)
+            translated_md = await translate_markdown(
+                md_text, progress_callback=on_progress, cancel_event=cancel_event
+            )
         finally:
             active_jobs.pop(user_id, None)
 
@@ -553,22 +636,18 @@ async def _run_translation(user, job: dict, message, context) -> None:
         img_dir = image_dir if image_dir.exists() and any(image_dir.iterdir()) else None
 
         if fmt == "epub":
-            # Generate styled cover for EPUB
-            epub_cover = generate_cover(
-                title=translated_title,
-                author=orig_author,
-                output_path=job_dir / "epub_cover.png",
-            )
-            markdown_to_epub(
+            # Generate styled cover for EPUB (kept in memory, EPUB is its only consumer)
+            epub_cover = generate_cover_bytes(title=translated_title, author=orig_author)
+            await markdown_to_epub(
                 translated_md,
                 output_file,
                 title=translated_title,
                 author=orig_author,
                 image_dir=img_dir,
-                cover_image_path=epub_cover,
+                cover_image_bytes=epub_cover,
             )
         else:
-            markdown_to_pdf(
+            await markdown_to_pdf(
                 translated_md,
                 output_file,
                 image_dir=img_dir,
@@ -580,21 +659,18 @@ async def _run_translation(user, job: dict, message, context) -> None:
         await status_msg.edit_text("📤 Отправляю...")
 
         u = await get_or_create_user(user_id, user.username or "")
-        with open(output_file, "rb") as f:
+        with output_file.open("rb") as f:
+            # Hand the open file to the HTTP client instead of reading it into memory first
             await message.reply_document(
-                document=f,
-                filename=output_file.name,
+                document=InputFile(f, filename=output_file.name, read_file_handle=False),
                 caption=f"✅ Перевод готов! Списано {cost} ⭐, баланс: {new_balance} ⭐",
                 reply_markup=_main_kb(new_balance, u["format"], _is_admin(user)),
             )
 
         await status_msg.delete()
 
-    except RuntimeError as e:
-        if "отменён" in str(e).lower():
-            await status_msg.edit_text("🛑 Перевод отменён. Звёзды не списаны.")
-        else:
-            await status_msg.edit_text(f"❌ Ошибка: {e}")
+    except TranslationCancelled:
+        await status_msg.edit_text("🛑 Перевод отменён. Звёзды не списаны.")
     except Exception as e:
         logger.exception("Error translating for user %s", user_id)
         try:
@@ -602,7 +678,7 @@ async def _run_translation(user, job: dict, message, context) -> None:
         except Exception:
             pass
     finally:
-        _cleanup(job_dir)
+        await _cleanup(job_dir)
 
 
 # --- Text handler (for admin gift + fallback) ---
@@ -666,22 +742,65 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
 
 
-def _cleanup(job_dir: Path) -> None:
-    import shutil
+_sweep_task: asyncio.Task | None = None
+
+
+def _remove_job_dir(job_dir: Path) -> None:
     try:
         shutil.rmtree(job_dir, ignore_errors=True)
     except Exception as e:
         logger.warning("Cleanup failed for %s: %s", job_dir, e)
 
 
+async def _cleanup(job_dir: Path) -> None:
+    """Remove a job directory in a worker thread so the event loop keeps serving updates."""
+    await asyncio.to_thread(_remove_job_dir, job_dir)
+
+
+def _cleanup_soon(job_dir: Path) -> None:
+    """Schedule job directory removal from synchronous code running on the event loop."""
+    asyncio.get_running_loop().run_in_executor(None, _remove_job_dir, job_dir)
+
+
+async def _sweep_jobs() -> None:
+    """Periodically drop expired jobs so abandoned job dirs are freed without new traffic."""
+    while True:
+        await asyncio.sleep(JOB_SWEEP_INTERVAL)
+        pending_jobs.expire()
+
+
+_BOT_COMMANDS = [
+    BotCommand("start", "Главное меню"),
+    BotCommand("help", "Помощь — PDF и EPUB перевод"),
+    BotCommand("cancel", "Отменить перевод"),
+    BotCommand("admin", "Админ-панель"),
+]
+_COMMANDS_HASH_FILE = DATA_DIR / ".bot_commands_hash"
+
+
+async def _sync_commands(bot) -> None:
+    """Send the command list to Telegram only if it changed since the last start."""
+    payload = (bot.id, [(c.command, c.description) for c in _BOT_COMMANDS])
+    digest = hashlib.sha1(repr(payload).encode()).hexdigest()
+    if _COMMANDS_HASH_FILE.exists() and _COMMANDS_HASH_FILE.read_text() == digest:
+        logger.info("Bot commands unchanged, skipping set_my_commands")
+        return
+    await bot.set_my_commands(_BOT_COMMANDS)
+    _COMMANDS_HASH_FILE.write_text(digest)
+
+
 async def _post_init(app: Application) -> None:
+    global _sweep_task
     await init_db()
-    await app.bot.set_my_commands([
-        BotCommand("start", "Главное меню"),
-        BotCommand("help", "Помощь — PDF и EPUB перевод"),
-        BotCommand("cancel", "Отменить перевод"),
-        BotCommand("admin", "Админ-панель"),
-    ])
+    # Fetch the tokenizer now: a missing download should stop startup, not block the first translation
+    await asyncio.to_thread(load_tokenizer)
+    _sweep_task = asyncio.create_task(_sweep_jobs())
+    await _sync_commands(app.bot)
+
+
+async def _post_shutdown(app: Application) -> None:
+    if _sweep_task:
+        _sweep_task.cancel()
 
 
 def register_handlers(app: Application) -> None:
@@ -695,3 +814,4 @@ def register_handlers(app: Application) -> None:
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.post_init = _post_init
+    app.post_shutdown = _post_shutdown
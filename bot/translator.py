@@ -1,16 +1,29 @@
+import functools
+import hashlib
+import json
 import logging
 import re
 import asyncio
 from collections.abc import Callable, Awaitable
+import tiktoken
 from openai import AsyncOpenAI
-from bot.config import OPENAI_API_KEY, OPENAI_MODEL, CHUNK_SIZE
+from bot.config import (
+    OPENAI_API_KEY, OPENAI_MODEL, OPENAI_USE_BATCH, CHUNK_TOKENS, TRANSLATOR_MAX_RETRIES,
+)
+from bot.database import get_cached_translations, save_translations
 
-DEFAULT_CHUNK_SIZE = max(CHUNK_SIZE, 8000)
 MAX_CONCURRENT = 10  # parallel OpenAI requests
+BATCH_MIN_CHUNKS = 20  # smaller documents skip the Batch API
+BATCH_POLL_INTERVAL = 30  # seconds between Batch status checks
+
+_BATCH_ENDPOINT = "/v1/chat/completions"
+_BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 logger = logging.getLogger(__name__)
 
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# The SDK retries connection errors, 408/409/429 and 5xx with exponential backoff,
+# honouring Retry-After; only the attempt count is ours to tune
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=TRANSLATOR_MAX_RETRIES)
 
 SYSTEM_PROMPT = (
     "Ты профессиональный переводчик книг. Переведи текст с английского на русский.\n"
@@ -28,106 +41,327 @@ SYSTEM_PROMPT = (
 
 # Pattern to match markdown images: ![alt text](path/to/image.png)
 _IMG_RE = re.compile(r'!\[[^\]]*\]\([^)]+\)')
+_PLACEHOLDER_RE = re.compile(r'<<IMG_(\d+)>>')
 
 
-def _protect_images(text: str) -> tuple[str, list[str]]:
-    """Replace image markdown with placeholders, return (cleaned_text, images)."""
-    images: list[str] = []
+def _restore_images(text: str, images: list[str]) -> str:
+    """Restore image placeholders back to original markdown."""
+    if not images:
+        return text
 
     def _replace(m: re.Match) -> str:
-        idx = len(images)
-        images.append(m.group(0))
-        return f"<<IMG_{idx}>>"
+        idx = int(m.group(1))
+        # Leave placeholders the model made up untouched
+        return images[idx] if idx < len(images) else m.group(0)
 
-    cleaned = _IMG_RE.sub(_replace, text)
-    return cleaned, images
+    return _PLACEHOLDER_RE.sub(_replace, text)
 
 
-def _restore_images(text: str, images: list[str]) -> str:
-    """Restore image placeholders back to original markdown."""
-    for idx, img_md in enumerate(images):
-        placeholder = f"<<IMG_{idx}>>"
-        text = text.replace(placeholder, img_md)
-    return text
+@functools.lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    """Tokenizer of OPENAI_MODEL (o200k_base for models tiktoken doesn't know).
+
+    The first call downloads the BPE file unless it is in tiktoken's cache,
+    the bot loads it at startup.
+    """
+    try:
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
 
 
-def split_into_chunks(text: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> list[str]:
-    """Split markdown text into chunks, respecting section boundaries."""
-    lines = text.split("\n")
+def load_tokenizer() -> None:
+    """Load the tokenizer ahead of the first translation (blocking, may download)."""
+    _encoding()
+
+
+def protect_and_split(text: str, chunk_tokens: int = CHUNK_TOKENS) -> tuple[list[str], list[str]]:
+    """Replace images with <<IMG_N>> placeholders and split into chunks in one pass.
+
+    Chunks hold about chunk_tokens tokens and break before a heading where possible.
+    Returns (chunks, images).
+    """
+    encode = _encoding().encode_ordinary
+    images: list[str] = []
+    matches = _IMG_RE.finditer(text)
+    m = next(matches, None)
     chunks: list[str] = []
-    current_chunk: list[str] = []
+    current: list[str] = []
     current_len = 0
+    text_len = len(text)
+    pos = 0
+
+    while True:
+        nl = text.find("\n", pos)
+        line_end = text_len if nl == -1 else nl
 
-    for line in lines:
-        line_len = len(line) + 1
-        is_heading = line.startswith("#")
+        # Swap images starting on this line for placeholders; an image spanning
+        # line breaks pulls the following lines into this one
+        parts: list[str] = []
+        seg_start = pos
+        while m is not None and m.start() < line_end:
+            parts.append(text[seg_start:m.start()])
+            parts.append(f"<<IMG_{len(images)}>>")
+            images.append(m.group(0))
+            seg_start = m.end()
+            if seg_start > line_end:
+                nl = text.find("\n", seg_start)
+                line_end = text_len if nl == -1 else nl
+            m = next(matches, None)
+        line = text[pos:line_end] if not parts else "".join(parts) + text[seg_start:line_end]
 
-        if current_len + line_len > chunk_size and current_chunk:
-            if is_heading:
-                chunks.append("\n".join(current_chunk))
-                current_chunk = [line]
+        # +1 counts the newline
+        line_len = len(encode(line)) + 1 if line else 1
+        if current_len + line_len > chunk_tokens and current:
+            if line.startswith("#"):
+                chunks.append("\n".join(current))
+                current = [line]
                 current_len = line_len
             else:
-                current_chunk.append(line)
-                current_len += line_len
-                chunks.append("\n".join(current_chunk))
-                current_chunk = []
+                current.append(line)
+                chunks.append("\n".join(current))
+                current = []
                 current_len = 0
         else:
-            current_chunk.append(line)
+            current.append(line)
             current_len += line_len
 
-    if current_chunk:
-        chunks.append("\n".join(current_chunk))
+        if nl == -1:
+            break
+        pos = nl + 1
 
-    return [c for c in chunks if c.strip()]
+    if current:
+        chunks.append("\n".join(current))
 
+    return [c for c in chunks if c.strip()], images
 
-async def translate_chunk(text: str) -> str:
-    """Translate a single text chunk via OpenAI."""
-    response = await client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
+
+def _cache_key(text: str) -> str:
+    """Translation cache key: changes with the model and the prompt as well as the text."""
+    return hashlib.sha256(f"{OPENAI_MODEL}\0{SYSTEM_PROMPT}\0{text}".encode()).hexdigest()
+
+
+def _chat_request(text: str) -> dict:
+    """Chat completion parameters for translating one chunk."""
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": text},
         ],
-        temperature=0.3,
-    )
+        "temperature": 0.3,
+    }
+
+
+async def translate_chunk(text: str) -> str:
+    """Translate a single text chunk via OpenAI."""
+    response = await client.chat.completions.create(**_chat_request(text))
     return response.choices[0].message.content or ""
 
 
-async def translate_markdown(
-    text: str,
+class TranslationCancelled(Exception):
+    """Raised when a translation is stopped through its cancel event."""
+
+
+async def _raise_on_cancel(cancel_event: asyncio.Event) -> None:
+    await cancel_event.wait()
+    raise TranslationCancelled
+
+
+async def _sleep_or_cancel(delay: float, cancel_event: asyncio.Event | None) -> None:
+    """Sleep for delay seconds, raising TranslationCancelled as soon as cancel_event is set."""
+    if cancel_event is None:
+        await asyncio.sleep(delay)
+        return
+    try:
+        async with asyncio.timeout(delay):
+            await cancel_event.wait()
+    except TimeoutError:
+        return
+    raise TranslationCancelled
+
+
+async def _translate_parallel(
+    chunks: list[str],
     progress_callback: Callable[[int, int], Awaitable[None]] | None = None,
-) -> str:
-    """Translate full markdown document with parallel API calls.
+    cancel_event: asyncio.Event | None = None,
+    on_result: Callable[[int, str], None] | None = None,
+) -> list[str]:
+    """Translate chunks with up to MAX_CONCURRENT parallel requests.
 
-    Images are protected from translation via placeholders and restored after.
+    Setting cancel_event aborts the workers together with their in-flight requests.
+    on_result(idx, translation) is called as each chunk finishes.
     """
-    # Protect images before chunking/translation
-    protected_text, images = _protect_images(text)
-    logger.info("Protected %d images from translation", len(images))
-
-    chunks = split_into_chunks(protected_text)
     total = len(chunks)
     logger.info("Translating %d chunks (max %d parallel)", total, MAX_CONCURRENT)
 
     results: list[str] = [""] * total
-    sem = asyncio.Semaphore(MAX_CONCURRENT)
+    queue: asyncio.Queue[tuple[int, str]] = asyncio.Queue()
+    for item in enumerate(chunks):
+        queue.put_nowait(item)
     done_count = 0
-    lock = asyncio.Lock()
 
-    async def _process(idx: int, chunk: str) -> None:
+    async def _worker() -> None:
+        # All workers share the event loop thread, so done_count needs no lock
         nonlocal done_count
-        async with sem:
+        while True:
+            try:
+                idx, chunk = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
             logger.info("Translating chunk %d/%d (%d chars)", idx + 1, total, len(chunk))
             results[idx] = await translate_chunk(chunk)
-            async with lock:
-                done_count += 1
-                if progress_callback:
-                    await progress_callback(done_count, total)
+            if on_result:
+                on_result(idx, results[idx])
+            done_count += 1
+            if progress_callback:
+                await progress_callback(done_count, total)
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            watcher = tg.create_task(_raise_on_cancel(cancel_event)) if cancel_event else None
+            workers = [tg.create_task(_worker()) for _ in range(min(MAX_CONCURRENT, total))]
+            if workers:
+                await asyncio.wait(workers)
+            if watcher:
+                watcher.cancel()
+    except ExceptionGroup as eg:
+        # Callers expect one error: cancellation if requested, else the first failure
+        cancelled = eg.subgroup(TranslationCancelled)
+        raise (cancelled or eg).exceptions[0] from None
+    return results
+
+
+async def _translate_batch(
+    chunks: list[str],
+    progress_callback: Callable[[int, int], Awaitable[None]] | None = None,
+    cancel_event: asyncio.Event | None = None,
+    on_result: Callable[[int, str], None] | None = None,
+) -> list[str]:
+    """Translate chunks as one OpenAI Batch job, polling until it finishes.
+
+    Chunks the batch did not return are translated with regular requests.
+    on_result(idx, translation) is called for every chunk as soon as it is available.
+    """
+    total = len(chunks)
+    payload = "\n".join(
+        json.dumps(
+            {
+                "custom_id": str(idx),
+                "method": "POST",
+                "url": _BATCH_ENDPOINT,
+                "body": _chat_request(chunk),
+            },
+            ensure_ascii=False,
+        )
+        for idx, chunk in enumerate(chunks)
+    ).encode()
+
+    input_file = await client.files.create(file=("chunks.jsonl", payload), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=_BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    logger.info("Submitted batch %s with %d chunks", batch.id, total)
+
+    try:
+        done_count = 0
+        while batch.status not in _BATCH_FINAL_STATUSES:
+            await _sleep_or_cancel(BATCH_POLL_INTERVAL, cancel_event)
+            batch = await client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            if progress_callback and counts and counts.completed != done_count:
+                done_count = counts.completed
+                await progress_callback(done_count, total)
+    except BaseException:
+        try:
+            await client.batches.cancel(batch.id)
+        except Exception:
+            logger.warning("Failed to cancel batch %s", batch.id, exc_info=True)
+        raise
+
+    results: list[str | None] = [None] * total
+    if batch.output_file_id:
+        content = await client.files.content(batch.output_file_id)
+        for line in content.text.splitlines():
+            if not line:
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            message = response["body"]["choices"][0]["message"]
+            idx = int(entry["custom_id"])
+            results[idx] = message.get("content") or ""
+            if on_result:
+                on_result(idx, results[idx])
+
+    missing = [idx for idx, result in enumerate(results) if result is None]
+    if missing:
+        logger.warning(
+            "Batch %s ended as %s, %d/%d chunks missing; translating them directly",
+            batch.id, batch.status, len(missing), total,
+        )
+        retried = await _translate_parallel(
+            [chunks[idx] for idx in missing],
+            cancel_event=cancel_event,
+            on_result=(lambda i, result: on_result(missing[i], result)) if on_result else None,
+        )
+        for idx, result in zip(missing, retried):
+            results[idx] = result
+
+    return results
+
+
+async def translate_markdown(
+    text: str,
+    progress_callback: Callable[[int, int], Awaitable[None]] | None = None,
+    use_batch: bool = OPENAI_USE_BATCH,
+    ignore_cache: bool = False,
+    cancel_event: asyncio.Event | None = None,
+) -> str:
+    """Translate full markdown document with parallel API calls or one Batch job.
+
+    Images are protected from translation via placeholders and restored after.
+    Chunks translated before (same model, prompt and text) are taken from the
+    translation cache unless ignore_cache is set.
+    Setting cancel_event stops the translation with TranslationCancelled.
+    The Batch API is only used for documents of at least BATCH_MIN_CHUNKS chunks,
+    below that its queueing latency outweighs the saved round trips.
+    """
+    # Protect images while chunking; tokenizing a whole book takes seconds, keep it off the event loop
+    chunks, images = await asyncio.to_thread(protect_and_split, text)
+    logger.info("Protected %d images from translation", len(images))
+
+    keys = [_cache_key(chunk) for chunk in chunks]
+    # Repeated chunks (boilerplate, running headers) are translated once
+    unique: dict[str, str] = {}
+    for key, chunk in zip(keys, chunks):
+        unique.setdefault(key, chunk)
+    logger.info("Dedup: %d chunks -> %d unique", len(chunks), len(unique))
+
+    cached = {} if ignore_cache else await get_cached_translations(list(unique))
+    missing = [key for key in unique if key not in cached]
+    logger.info("Translation cache: %d/%d unique chunks hit", len(unique) - len(missing), len(unique))
+
+    to_translate = [unique[key] for key in missing]
+    fresh: dict[str, str] = {}
+
+    def _on_result(idx: int, result: str) -> None:
+        fresh[missing[idx]] = result
+
+    try:
+        if use_batch and len(to_translate) >= BATCH_MIN_CHUNKS:
+            await _translate_batch(to_translate, progress_callback, cancel_event, _on_result)
+        else:
+            await _translate_parallel(to_translate, progress_callback, cancel_event, _on_result)
+    finally:
+        # Also after a failure or cancel, so a retry takes the finished chunks from the cache.
+        # Empty answers are not cached so a retry asks the model again
+        await save_translations([(key, result) for key, result in fresh.items() if result])
 
-    await asyncio.gather(*[_process(i, c) for i, c in enumerate(chunks)])
+    results = [fresh[key] if key in fresh else cached[key] for key in keys]
 
     translated = "\n\n".join(results)
 
@@ -0,0 +1,5 @@
+import os
+
+# bot.translator creates the OpenAI client on import and it refuses to start without a key;
+# the tests never call the API
+os.environ.setdefault("OPENAI_API_KEY", "test")
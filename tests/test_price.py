@@ -0,0 +1,44 @@
+import pytest
+
+EXPECTED_PRICE = 20
+
+
+@pytest.fixture(scope="session")
+def config_mod():
+    from bot import config
+    return config
+
+
+@pytest.fixture(scope="session")
+def handlers_mod():
+    # Imported once per session: handlers pulls in telegram, openai and the PDF/EPUB stack
+    from bot import handlers
+    return handlers
+
+
+def test_config_price(config_mod):
+    assert config_mod.STARS_PER_50_PAGES == EXPECTED_PRICE
+
+
+@pytest.mark.parametrize("pages,expected", [
+    (50, 20),
+    (0, 1),
+    (1, 1),
+    (7, 3),
+    (51, 21),
+    (125, 50),
+])
+def test_calc_cost(handlers_mod, pages, expected):
+    assert handlers_mod._calc_cost(pages) == expected
+
+
+# Each package advertises the pages its stars buy at EXPECTED_PRICE
+@pytest.mark.parametrize("stars,fragment", [
+    (10, "~25 стр"),
+    (50, "~125 стр"),
+    (150, "~375 стр"),
+    (500, "~1250 стр"),
+])
+def test_star_package_label(handlers_mod, stars, fragment):
+    labels = dict(handlers_mod.STAR_PACKAGES)
+    assert fragment in labels[stars]